@@ -14,32 +14,62 @@
 # You should have received a copy of the GNU General Public License
 # along with Stream Watchdog. If not, see <https://www.gnu.org/licenses/>.
 import requests
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Use orjson for faster decoding of polled responses when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Shared session so every poll reuses the same keep-alive connection
+session = requests.Session()
+session.headers.update({"accept": "application/json"})
+# Timed-out reads aren't retried so REQUEST_TIMEOUT bounds each poll
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=Retry(total=2, read=0, backoff_factor=0.2))
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+REQUEST_TIMEOUT = (2, 5)  # (connect, read) seconds, so a hung server can't stall the watchdog
+
+# Short-lived cache so switches issued in the same moment share one fetch
+STREAMS_CACHE_TTL = 1.0  # Seconds
+streams_cache = {}  # (expiry, streams, watchdog_names) keyed by server URL
+
+def invalidate_streams_cache():
+    """Drop cached stream lists so the next call fetches fresh data."""
+    streams_cache.clear()
 
 def stream_url_template(AIPTV_SERVER_URL):
     return f"{AIPTV_SERVER_URL}/api/proxy/{{id}}"
 
 def get_running_streams(AIPTV_SERVER_URL, USERNAME = None, PASSWORD = None):
     """Fetch current running streams from the API."""
+    cached = streams_cache.get(AIPTV_SERVER_URL)
+    if cached and time.monotonic() < cached[0]:
+        # Return copies so callers can't modify the cached entry
+        return list(cached[1]), dict(cached[2])
     ACTIVE_CHANNELS_API = f"{AIPTV_SERVER_URL}/api/proxy/streams/active"
     watchdog_names = {}  # Initialize watchdog_names as an empty dictionary
     try:
-        response = requests.get(
-            ACTIVE_CHANNELS_API,
-            headers={"accept": "application/json"}
-        )
+        response = session.get(ACTIVE_CHANNELS_API, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        streams = response.json()
+        streams = orjson.loads(response.content) if orjson else response.json()
 
-        # Create a list of stream dictionaries
-        processed_streams = [
-            {
-                "id": stream.get("channelId"),
-                "name": stream.get("streamName"),
+        # Build the stream list and watchdog_names in a single pass
+        processed_streams = []
+        for stream in streams:
+            stream_id = stream.get("channelId")
+            stream_name = stream.get("streamName")
+            processed_streams.append({
+                "id": stream_id,
+                "name": stream_name,
                 "currentstream": stream.get("streamId"),
-                "clients": [
+                "clients": tuple(
                     client.get("userAgent")
-                    for client in stream.get("clients", [])
-                ],
+                    for client in stream.get("clients", ())
+                ),
                 "availableStreams": [
                     {
                         "id": available_stream.get("id"),
@@ -47,18 +77,12 @@ def get_running_streams(AIPTV_SERVER_URL, USERNAME = None, PASSWORD = None):
                     }
                     for available_stream in stream.get("availableStreams", [])
                 ],
-            }
-            for stream in streams
-        ]
-
-        # Populate watchdog_names
-        for stream in processed_streams:
-            stream_id = stream.get("id")
-            stream_name = stream.get("name") or "Unknown Channel"
+            })
             if stream_id:
-                watchdog_names[stream_id] = stream_name  # Store name by stream ID
+                watchdog_names[stream_id] = stream_name or "Unknown Channel"  # Store name by stream ID
 
-        return processed_streams, watchdog_names  # Return both values
+        streams_cache[AIPTV_SERVER_URL] = (time.monotonic() + STREAMS_CACHE_TTL, processed_streams, watchdog_names)
+        return list(processed_streams), dict(watchdog_names)  # Return both values
     except requests.exceptions.RequestException as e:
         print(f"HTTP error occurred: {e}")
     except Exception as e:
@@ -82,13 +106,15 @@ def send_next_stream(channel_id,AIPTV_SERVER_URL, USERNAME = None, PASSWORD = No
         # If a next stream is found, proceed to switch
         if next_stream_id != current_stream_id:
             url = f"{AIPTV_SERVER_URL}/api/proxy/stream/{channel_id}/switch"
-            headers = {
-                "accept": "application/json",
-                "Content-Type": "application/json"
-            }
             payload = {"streamId": next_stream_id}
-            response = requests.post(url, json=payload, headers=headers)
+            try:
+                response = session.post(url, json=payload, timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                print(f"HTTP error switching stream: {e}")
+                return False
             if response.status_code == 200:
+                # The current stream changed, make sure the next poll sees it
+                invalidate_streams_cache()
                 #print(f"Stream switched successfully to {next_stream_id}: {response.json()}")
                 return True
             else:
@@ -104,22 +130,11 @@ def send_next_stream(channel_id,AIPTV_SERVER_URL, USERNAME = None, PASSWORD = No
 
 def find_next_stream_after_current(available_streams, current_stream_id, USERNAME = None, PASSWORD = None):
     """Find the next available stream after the current one in the list."""
-    # Transform available streams to a list of dictionaries
-    available_streams_by_id = {stream["id"]: stream for stream in available_streams}
-    # Check if the current stream ID exists in the available streams
-    if current_stream_id in available_streams_by_id:
-        # Find the list of available stream IDs
-        available_stream_ids = list(available_streams_by_id.keys())
-
-        # Find the index of the current stream in the list of available stream IDs
-        current_index = available_stream_ids.index(current_stream_id)
-        # If there's a next stream in the list, return it
-        if current_index + 1 < len(available_stream_ids):
-            next_stream_id = available_stream_ids[current_index + 1]
-            return next_stream_id  # Return the next stream dictionary
-        elif current_index +1 == len(available_stream_ids):
-            next_stream_id = available_stream_ids[0]
-            return next_stream_id # Return the first stream in the dictionary after reaching the end
+    for index, stream in enumerate(available_streams):
+        if stream["id"] == current_stream_id:
+            # Wrap around to the first stream after reaching the end
+            next_stream = available_streams[(index + 1) % len(available_streams)]
+            return next_stream["id"]
     return None  # Return None if no next stream is found
 
 # Test the function
@@ -15,35 +15,65 @@
 # along with Stream Watchdog. If not, see <https://www.gnu.org/licenses/>.
 
 import requests
+import threading
 import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Use orjson for faster decoding of polled responses when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 session = None
+session_lock = threading.Lock()  # Only one thread logs in or refreshes the token at a time
 refresh_token = None
-token_expiry = 0  # Track when token will expire
+# Wall clock time at which the access token should be refreshed. The server expires tokens by wall clock,
+# and the monotonic clock stops while the host is suspended, so it would miss expiries after a resume.
+token_refresh_time = 0
+TOKEN_LIFETIME = 1800  # Access tokens expire after 30 minutes
+TOKEN_REFRESH_MARGIN = 60  # Refresh 1 minute before expiry
+REQUEST_TIMEOUT = (2, 5)  # (connect, read) seconds, so a hung server can't stall the watchdog
 
 def stream_url_template(SERVER_URL):
     return f"{SERVER_URL}/proxy/ts/stream/{{id}}"
 
 def login(dispatcharr_url, USERNAME, PASSWORD):
-    global session, refresh_token, token_expiry
+    global session, refresh_token, token_refresh_time
     if session is None:
-        session = requests.Session()
+        new_session = requests.Session()
+        # Retry transient failures instead of dropping the session and logging in again
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=32,
+            # Timed-out reads aren't retried so REQUEST_TIMEOUT bounds each poll
+            max_retries=Retry(total=3, read=0, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+        )
+        new_session.mount("http://", adapter)
+        new_session.mount("https://", adapter)
+        # Set default headers once so individual requests don't need to merge them
+        new_session.headers.update({"Accept": "application/json"})
         if USERNAME is None:
-            # Return an empty session if no username is supplied
+            # Return an unauthenticated session if no username is supplied
             print(f"No credentials provided, skipping login.")
-            return requests.session()
+            token_refresh_time = float("inf")  # No token to refresh
+            session = new_session
+            return session
         # Define login URL and credentials
         login_url = f"{dispatcharr_url}/api/accounts/token/"
         credentials = {"username": USERNAME, "password": PASSWORD}
         # Perform the login
         try:
-            response = session.post(login_url, data=credentials)
+            response = new_session.post(login_url, data=credentials, timeout=REQUEST_TIMEOUT)
             if response.status_code == 200:
                 print(f"Successfully logged in!")
                 tokens = response.json()
-                session.headers.update({"Authorization": f"Bearer {tokens['access']}"})  # Add access token to headers
+                new_session.headers.update({"Authorization": f"Bearer {tokens['access']}"})  # Add access token to headers
                 refresh_token = tokens.get('refresh')  # Store refresh token
-                token_expiry = time.time() + 1800  # Set expiry to 30 minutes from now
+                token_refresh_time = time.time() + TOKEN_LIFETIME - TOKEN_REFRESH_MARGIN
+                # Only share the session once it carries the access token
+                session = new_session
             elif response.status_code == 400:
                 print(f"Invalid credentials provided!")
                 return None
@@ -61,7 +91,7 @@ def login(dispatcharr_url, USERNAME, PASSWORD):
 
 def refresh_access_token(dispatcharr_url):
     """Refresh the access token using the refresh token."""
-    global session, refresh_token, token_expiry
+    global session, refresh_token, token_refresh_time
 
     if not refresh_token:
         print("No refresh token available. Need to login again.")
@@ -73,7 +103,7 @@ def refresh_access_token(dispatcharr_url):
     try:
         # Use a new session for this request to avoid using expired headers
         temp_session = requests.Session()
-        response = temp_session.post(refresh_url, json=payload)
+        response = temp_session.post(refresh_url, json=payload, timeout=REQUEST_TIMEOUT)
 
         if response.status_code == 200:
             tokens = response.json()
@@ -81,7 +111,7 @@ def refresh_access_token(dispatcharr_url):
             # Update refresh token if a new one is provided
             if 'refresh' in tokens:
                 refresh_token = tokens['refresh']
-            token_expiry = time.time() + 1800  # Reset expiry time
+            token_refresh_time = time.time() + TOKEN_LIFETIME - TOKEN_REFRESH_MARGIN
             print("Access token refreshed successfully")
             return True
         else:
@@ -91,129 +121,101 @@ def refresh_access_token(dispatcharr_url):
         print(f"Error refreshing token: {e}")
         return False
 
+def ensure_session(dispatcharr_url, USERNAME, PASSWORD):
+    """Return a logged in session, refreshing the access token when it is due."""
+    global session
+    with session_lock:
+        # Check if we have a session and if we need to refresh the token
+        if session is None:
+            return login(dispatcharr_url, USERNAME, PASSWORD)
+        if time.time() >= token_refresh_time and not refresh_access_token(dispatcharr_url):
+            # If refresh fails, drop the session and login again
+            session = None
+            return login(dispatcharr_url, USERNAME, PASSWORD)
+        return session
+
+def renew_session(dispatcharr_url, USERNAME, PASSWORD, rejected_session):
+    """Return a session with a new access token after the server rejected rejected_session."""
+    global session
+    with session_lock:
+        # Another thread may have logged in again while the rejected request was in flight
+        if session is not None and session is not rejected_session:
+            return session
+        if session is not None and refresh_access_token(dispatcharr_url):
+            return session
+        # If refresh fails, drop the session and login again
+        session = None
+        return login(dispatcharr_url, USERNAME, PASSWORD)
+
+def authenticated_request(method, url, dispatcharr_url, USERNAME, PASSWORD):
+    """Send a request with the shared session, renewing the access token and retrying once on a 401."""
+    current_session = ensure_session(dispatcharr_url, USERNAME, PASSWORD)
+    # Check if session was returned indicating login is successful or not needed
+    if current_session is None:
+        return None
+    response = current_session.request(method, url, timeout=REQUEST_TIMEOUT)
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code != 401:
+            raise
+        print("Token appears expired. Attempting refresh...")
+        current_session = renew_session(dispatcharr_url, USERNAME, PASSWORD, current_session)
+        if current_session is None:
+            return None
+        # Retry the request with the refreshed token
+        response = current_session.request(method, url, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+    return response
+
 def get_running_streams(dispatcharr_url, USERNAME=None, PASSWORD=None):
     """Fetch current running streams from the API."""
-    global session, token_expiry
     watchdog_names = {}  # Store stream names
-    headers = {"Accept": "application/json"}
     try:
         CHANNEL_METRICS_API_URL = f"{dispatcharr_url}/proxy/ts/status"
 
-        # Check if we have a session and if we need to refresh the token
-        if session is None:
-            session = login(dispatcharr_url, USERNAME, PASSWORD)
-        elif time.time() > token_expiry - 60:  # Refresh 1 minute before expiry
-            if not refresh_access_token(dispatcharr_url):
-                # If refresh fails, try to login again
-                session = login(dispatcharr_url, USERNAME, PASSWORD)
-
-        # Check if session was returned indicating login is successful or not needed
-        if session is None:
+        response = authenticated_request("GET", CHANNEL_METRICS_API_URL, dispatcharr_url, USERNAME, PASSWORD)
+        if response is None:
             # Connection error return empty response to not crash watchdog
             return [], {}
-
-        # Merge session headers with additional headers
-        merged_headers = {**session.headers, **headers}
-
-        response = session.get(CHANNEL_METRICS_API_URL, headers=merged_headers)
-
-        # Handle potential token expiration
-        if response.status_code == 401:
-            print("Token appears expired. Attempting refresh...")
-            if refresh_access_token(dispatcharr_url):
-                # Retry the request with refreshed token
-                merged_headers = {**session.headers, **headers}
-                response = session.get(CHANNEL_METRICS_API_URL, headers=merged_headers)
-            else:
-                # If refresh failed, try logging in again
-                session = login(dispatcharr_url, USERNAME, PASSWORD)
-                if session is not None:
-                    merged_headers = {**session.headers, **headers}
-                    response = session.get(CHANNEL_METRICS_API_URL, headers=merged_headers)
-
-        response.raise_for_status()
         # Ensure the response status code is 200
         if response.status_code != 200:
             print(f"Unexpected response status: {response.status_code}")
             return [], {}
-        data = response.json()
+        data = orjson.loads(response.content) if orjson else response.json()
 
-        # Parse the new data structure
-        channels = data.get("channels", [])
-        for channel in channels:
+        # Walk the channels once, only building entries for active ones
+        running_streams = []
+        for channel in data.get("channels", []):
             channel_id = channel.get("channel_id")
             stream_name = channel.get("stream_name", "Unknown Name")
             if channel_id:
                 watchdog_names[channel_id] = stream_name  # Store name by channel ID
-
-        return [
-            {
-                "id": channel.get("channel_id"),
-                "name": channel.get("stream_name", "Unknown Name"),
-                "clients": [
-                    client.get("user_agent", "")
-                    for client in channel.get("clients", [])
-                ],
-            }
-            for channel in channels if channel.get("state") == "active"
-        ], watchdog_names  # Return both the streams and the dictionary
+            if channel.get("state") == "active":
+                running_streams.append({
+                    "id": channel_id,
+                    "name": stream_name,
+                    "clients": tuple(
+                        client.get("user_agent", "")
+                        for client in channel.get("clients", ())
+                    ),
+                })
+
+        return running_streams, watchdog_names  # Return both the streams and the dictionary
     except Exception as e:
         print(f"Error fetching streams: {e}")
-        session = None
         return [], {}  # Return empty structures on failure
 
 def send_next_stream(channel_id, dispatcharr_url, USERNAME = None, PASSWORD = None):
     """Handle the buffering event by switching to the next stream."""
-    global session, token_expiry
     try:
         NEXT_STREAM_API_URL = f"{dispatcharr_url}/proxy/ts/next_stream/{channel_id}"
         print(f"Url to switch stream: {NEXT_STREAM_API_URL}")
 
-        # Check if we have a session and if we need to refresh the token
-        if session is None:
-            session = login(dispatcharr_url, USERNAME, PASSWORD)
-        elif time.time() > token_expiry - 60:  # Refresh 1 minute before expiry
-            if not refresh_access_token(dispatcharr_url):
-                # If refresh fails, try to login again
-                session = login(dispatcharr_url, USERNAME, PASSWORD)
-
-        # Check if session was returned indicating login is successful
-        if session is None:
+        response = authenticated_request("POST", NEXT_STREAM_API_URL, dispatcharr_url, USERNAME, PASSWORD)
+        # Check if a response was returned indicating login is successful
+        if response is None:
             return False
-
-        response = session.post(
-            NEXT_STREAM_API_URL,
-            headers={
-                "accept": "application/json",
-                "Content-Type": "application/json",
-            },
-        )
-
-        # Handle potential token expiration
-        if response.status_code == 401:
-            print("Token appears expired. Attempting refresh...")
-            if refresh_access_token(dispatcharr_url):
-                # Retry the request with refreshed token
-                response = session.post(
-                    NEXT_STREAM_API_URL,
-                    headers={
-                        "accept": "application/json",
-                        "Content-Type": "application/json",
-                    },
-                )
-            else:
-                # If refresh failed, try logging in again
-                session = login(dispatcharr_url, USERNAME, PASSWORD)
-                if session is not None:
-                    response = session.post(
-                        NEXT_STREAM_API_URL,
-                        headers={
-                            "accept": "application/json",
-                            "Content-Type": "application/json",
-                        },
-                    )
-
-        response.raise_for_status()
         result = response.json()  # Parse the JSON response
         # Log the result of switching the stream
         if result.get("message", 'Stream switched to next available'):
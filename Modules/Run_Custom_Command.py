@@ -50,47 +50,31 @@ def execute_and_monitor_command(command, timeout=30):
     start_time = time.time()
 
     try:
-        # Start the process without waiting for it to complete
-        process = subprocess.Popen(
+        # Run the process, killing it if it exceeds the timeout
+        process = subprocess.run(
             command,
             shell=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            capture_output=True,
             text=True,
+            timeout=timeout,
         )
-
-        # Monitor the process for the timeout
-        while True:
-            if process.poll() is not None:  # Process completed
-                break
-
-            elapsed_time = time.time() - start_time
-            if elapsed_time > timeout:
-                # Kill the process if it exceeds the timeout
-                #os.kill(process.pid, signal.SIGTERM)  # Send SIGTERM
-                process.terminate()
-                process.wait()
-                result["status"] = "Timeout"
-                result["error"] = f"Command timed out after {timeout} seconds."
-                print(result["error"])
-                break
-
-            time.sleep(0.1)  # Avoid busy waiting
-
-        # Collect output if process completed within the timeout
-        if process.poll() is not None:
-            stdout, stderr = process.communicate()
-            result["output"] = stdout
-            if process.returncode != 0:
-                result["status"] = "Error"
-                result["error"] = stderr or "An error occurred during command execution."
-            else:
-                # Print output if successful
-                print(f"Successfully ran command: {result['output']}")
+        result["output"] = process.stdout
+        if process.returncode != 0:
+            result["status"] = "Error"
+            result["error"] = process.stderr or "An error occurred during command execution."
+        else:
+            # Print output if successful
+            print(f"Successfully ran command: {result['output']}")
+    except subprocess.TimeoutExpired:
+        result["status"] = "Timeout"
+        result["error"] = f"Command timed out after {timeout} seconds."
+        print(result["error"])
     except Exception as e:
         result["status"] = "Error"
         result["error"] = str(e)
         print(f"Unexpected error: {result['error']}")
+    result["runtime"] = time.time() - start_time
+    return result
 
 # Test custom command
 if __name__ == "__main__":
@@ -15,54 +15,87 @@
 # along with Stream Watchdog. If not, see <https://www.gnu.org/licenses/>.
 
 import requests
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Use orjson for faster decoding of polled responses when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 session = None
+session_lock = threading.Lock()  # Only one thread logs in at a time
+REQUEST_TIMEOUT = (2, 5)  # (connect, read) seconds, so a hung server can't stall the watchdog
 
 def stream_url_template(SERVER_URL):
     return f"{SERVER_URL}/v/0/{{id}}"
 
 def login(stream_master_url, USERNAME, PASSWORD):
     global session
-    if session is None:
-        session = requests.Session()
-        if USERNAME is None:
-            # Return an empty session if no username is supplied
-            print(f"No credentials provided, skipping login.")
-            return requests.session()
-        # Define login URL and credentials
-        login_url = f"{stream_master_url}/login"
-        credentials = {"username": USERNAME, "password": PASSWORD}
-        # Perform the login
-        try:
-            session.post(login_url, data=credentials)
-        except requests.exceptions.ConnectionError as e:
-            print(f"Unable to connect to Stream Master! Error: {e}")
-            return None
-        except Exception as e:
-            print(f"Error logging in: {e}")
-            return None
-        if not session.cookies:
-            print(f"Failed to log in, please verify username and password!")
-            return None
-        else:
-            print(f"Successfully logged in!")
+    with session_lock:
+        if session is None:
+            new_session = requests.Session()
+            # Size the pool for polling plus concurrent switches and retry transient failures
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=32,
+                # Timed-out reads aren't retried so REQUEST_TIMEOUT bounds each poll
+                max_retries=Retry(total=2, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+            )
+            new_session.mount("http://", adapter)
+            new_session.mount("https://", adapter)
+            if USERNAME is None:
+                # Return an unauthenticated session if no username is supplied
+                print(f"No credentials provided, skipping login.")
+                session = new_session
+                return session
+            # Define login URL and credentials
+            login_url = f"{stream_master_url}/login"
+            credentials = {"username": USERNAME, "password": PASSWORD}
+            # Perform the login
+            try:
+                new_session.post(login_url, data=credentials, timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.ConnectionError as e:
+                print(f"Unable to connect to Stream Master! Error: {e}")
+                return None
+            except Exception as e:
+                print(f"Error logging in: {e}")
+                return None
+            if not new_session.cookies:
+                print(f"Failed to log in, please verify username and password!")
+                return None
+            else:
+                print(f"Successfully logged in!")
+            # Only share the session once it carries the login cookie
+            session = new_session
 
-    return session
+        return session
+
+def drop_session(rejected_session):
+    """Forget the shared session if it is still the one Stream Master rejected."""
+    global session
+    with session_lock:
+        if session is rejected_session:
+            session = None
+
+def session_rejected(response):
+    """Return True if Stream Master answered with an auth error or a redirect to its login page."""
+    return response.status_code in (401, 403) or response.is_redirect
 
 def get_running_streams(stream_master_url, USERNAME = None, PASSWORD= None):
     """Fetch current running streams from the API."""
-    global session
     watchdog_names = {}  # Store stream names
     headers = {"Accept": "application/json"}
     try:
         CHANNEL_METRICS_API_URL = f"{stream_master_url}/api/statistics/getchannelmetrics"
-        session = login(stream_master_url, USERNAME, PASSWORD)
+        current_session = login(stream_master_url, USERNAME, PASSWORD)
         # Check if session was returned indicating login is successful or not needed
-        if session is None:
+        if current_session is None:
             # Connection error return empty response to not crash watchdog
             return [],{}
-        response = session.get(CHANNEL_METRICS_API_URL, headers=headers, allow_redirects=False)
-        response.raise_for_status()
+        response = current_session.get(CHANNEL_METRICS_API_URL, headers=headers, allow_redirects=False, timeout=REQUEST_TIMEOUT)
         # Check if a redirect occured indicating a login might be required
         if response.is_redirect:
             #if response.next.path_url == '/login':
@@ -71,55 +104,71 @@ def get_running_streams(stream_master_url, USERNAME = None, PASSWORD= None):
                 print("Login page detected, is authentication enabled in Stream Master?")
             else:
                 print(f"Redirect detected to: {redirect_location}, is authentication enabled in Stream Master?")
-            # Stop processing response and return empty
+            # Log in again on the next poll, stop processing response and return empty
+            drop_session(current_session)
             return [],{}
-        streams = response.json()
+        if session_rejected(response):
+            print("Stream Master rejected the session, logging in again on the next poll...")
+            drop_session(current_session)
+            return [],{}
+        response.raise_for_status()
+        streams = orjson.loads(response.content) if orjson else response.json()
 
-        # Update the watchdog_names dictionary with stream names
+        # Resolve each stream's keys once, filling watchdog_names and the stream list together
+        running_streams = []
         for stream in streams:
-            stream_id = stream.get("id") or stream.get("Id")
-            stream_name = stream.get("name") or stream.get("Name", "Unknown Channel")
+            stream_id = stream.get("id") or stream.get("Id")  # Handle both "id" and "Id"
+            stream_name = stream.get("name") or stream.get("Name", "Unknown Channel")  # Handle both "name" and "Name"
             if stream_id:
                 watchdog_names[stream_id] = stream_name  # Store name by stream ID
+            if not stream.get("isFailed", False):
+                running_streams.append({
+                    "id": stream_id,
+                    "name": stream_name,
+                    "clients": tuple(
+                        client.get("clientUserAgent") or client.get("ClientUserAgent", "")
+                        for client in stream.get("clientStreams") or stream.get("ClientStreams", ())
+                    ),
+                })
 
-        return [
-            {
-                "id": stream.get("id") or stream.get("Id"),  # Handle both "id" and "Id"
-                "name": stream.get("name") or stream.get("Name", "Unknown Channel"),  # Handle both "name" and "Name"
-                "clients": [
-                    client.get("clientUserAgent") or client.get("ClientUserAgent", "")
-                    for client in stream.get("clientStreams") or stream.get("ClientStreams", [])
-                ],
-            }
-            for stream in streams if not stream.get("isFailed", False)
-        ], watchdog_names  # Return both the streams and the dictionary
+        return running_streams, watchdog_names  # Return both the streams and the dictionary
     except Exception as e:
         print(f"Error fetching streams: {e}")
-        session = None
         return [], {}  # Return empty structures on failure
 
 def send_next_stream(stream_id, stream_master_url, USERNAME = None, PASSWORD = None):
     """Handle the buffering event by switching to the next stream."""
     try:
         NEXT_STREAM_API_URL = f"{stream_master_url}/api/streaming/movetonextstream"
-        # Trigger the next stream switch
-        session = login(stream_master_url, USERNAME, PASSWORD)
         payload = {"SMChannelId": stream_id}
-        response = session.patch(
-            NEXT_STREAM_API_URL,
-            json=payload,
-            headers={
-                "accept": "application/json",
-                "Content-Type": "application/json",
-            },
-        )
-        response.raise_for_status()
-        result = response.json()  # Parse the JSON response
-        # Log the result of switching the stream
-        if not result.get("isError", True) or not result.get("IsError", True):
-            return True
+        # Trigger the next stream switch, logging in again once if the session was rejected
+        for _ in range(2):
+            # Reuses the existing session, only logs in when there is none
+            current_session = login(stream_master_url, USERNAME, PASSWORD)
+            if current_session is None:
+                return False
+            response = current_session.patch(
+                NEXT_STREAM_API_URL,
+                json=payload,
+                headers={
+                    "accept": "application/json",
+                    "Content-Type": "application/json",
+                },
+                allow_redirects=False,
+                timeout=REQUEST_TIMEOUT,
+            )
+            if not session_rejected(response):
+                break
+            print("Stream Master rejected the session.")
+            drop_session(current_session)
         else:
+            print(f"Stream Master rejected the switch for channel {stream_id} again after logging in, please verify username and password!")
             return False
+        response.raise_for_status()
+        result = response.json()  # Parse the JSON response
+        # Stream Master may answer with either "isError" or "IsError", treat a missing flag as an error
+        is_error = result.get("isError", result.get("IsError", True))
+        return not is_error
 
     except Exception as e:
         print(f"Error switching to the next stream for channel {stream_id}: {e}")
@@ -20,7 +20,7 @@ import time
 import os
 import importlib
 import psutil
-from threading import Thread
+from threading import Thread, Lock
 
 # Read environment variables
 SERVER_URL = os.getenv("SERVER_URL")  # No default value
@@ -40,13 +40,66 @@ FFMPEG_PATH = os.getenv("FFMPEG_PATH", "/usr/bin/ffmpeg") # Default to "/usr/bin
 MODULE = os.getenv("MODULE", "Dispatcharr") # Default to "Dispatcharr"
 MAX_FFMPEG_MEMORY_MB = int(os.getenv("MAX_FFMPEG_MEMORY_MB", 150))  # Default to 150 MB
 
+# Prefix of the speed line in FFmpeg's -progress output (e.g. b"speed=1.01x")
+SPEED_PREFIX = b"speed="
+# Every -progress line starts with a lowercase key and "=", values may be padded (e.g. b"bitrate= 512.3kbits/s")
+PROGRESS_LINE = re.compile(rb"[a-z0-9_]+=")
+# FFmpeg errors counted towards switching streams when ERROR_THRESHOLD is set, joined so each line is scanned once
+ERROR_PATTERN = re.compile(
+    rb"corrupt decoded frame"
+    rb"|error while decoding"
+    rb"|Invalid data found when processing input"
+    rb"|Reference \d+ >= \d+"
+    rb"|concealing \d+ DC, \d+ AC, \d+ MV errors"
+)
 
-# Maintain running processes, speeds, and buffering timers with stream names
-watchdog_processes = {}
-watchdog_speeds = {}
-watchdog_names = {}  # Store stream names
-buffer_start_times = {}
-action_triggered = set()
+# FFmpeg arguments before and after the stream URL, these only depend on settings so build them once
+if ERROR_THRESHOLD:
+    # Keep FFmpeg's default info level, concealment messages are logged at info and count as errors
+    FFMPEG_LOGLEVEL = "info"
+    FFMPEG_OUTPUT_ARGS = (
+        "-fflags", "nobuffer",
+        "-flags", "low_delay",
+        "-max_muxing_queue_size", "512",
+        "-f", "null",
+        "null",
+    )
+else:
+    # Error checking is off, so only the progress output is needed
+    FFMPEG_LOGLEVEL = "error"
+    FFMPEG_OUTPUT_ARGS = (
+        "-c", "copy",
+        "-f", "null",
+        "null",
+    )
+FFMPEG_INPUT_ARGS = (
+    FFMPEG_PATH,
+    "-hide_banner",
+    "-loglevel", FFMPEG_LOGLEVEL,
+    "-nostats",
+    "-progress", "pipe:2",
+    "-user_agent", USER_AGENT,
+    "-fflags", "+nobuffer+discardcorrupt",
+    "-flags", "low_delay",
+    "-rtbufsize", "10M",
+    "-i",
+)
+
+
+class Watchdog:
+    """State of the FFmpeg watchdog running for a single stream."""
+    __slots__ = ("process", "name", "speed", "buffer_start", "psutil_process")
+
+    def __init__(self, process, name):
+        self.process = process
+        self.name = name
+        self.speed = None  # Last speed reported by FFmpeg
+        self.buffer_start = None  # Monotonic time buffering was first detected
+        self.psutil_process = None  # Reused by the memory check, created on first use
+
+# Maintain running watchdogs keyed by stream ID
+watchdogs = {}
+watchdogs_lock = Lock()  # Guards watchdogs, it is changed by the main loop and monitor threads
 
 def startup():
     # Exit if SERVER_URL is not defined
@@ -56,7 +109,7 @@ def startup():
         print(f"Using server URL: {SERVER_URL}")
 
     # Import the required module dynamically
-    global get_running_streams, send_next_stream, stream_url_template, execute_and_monitor_command
+    global get_running_streams, send_next_stream, stream_url_template, stream_url_format, execute_and_monitor_command
     module_path = f"Modules.{MODULE}"
     try:
         module = importlib.import_module(module_path)
@@ -64,6 +117,8 @@ def startup():
         get_running_streams = getattr(module, "get_running_streams")
         send_next_stream = getattr(module, "send_next_stream")
         stream_url_template = getattr(module, "stream_url_template")
+        # The server URL never changes, so build the stream URL template once
+        stream_url_format = stream_url_template(SERVER_URL)
         print(f"Successfully imported functions from {module_path}")
     except ModuleNotFoundError:
         raise Exception(f"Error: Module '{module_path}' not found. Ensure the MODULE environment variable is set correctly.")
@@ -97,51 +152,31 @@ def get_version():
 
 def start_watchdog(stream_id, stream_name):
     """Start the FFmpeg watchdog process for a given stream ID."""
-    global watchdog_names
-    video_url = stream_url_template(SERVER_URL).format(id=stream_id)
-    if ERROR_THRESHOLD:
-        ffmpeg_args = [
-            FFMPEG_PATH,
-            "-hide_banner",
-            "-user_agent", USER_AGENT,
-            "-fflags", "+nobuffer+discardcorrupt",
-            "-flags", "low_delay",
-            "-rtbufsize", "10M",
-            "-i", video_url,
-            "-fflags", "nobuffer",
-            "-flags", "low_delay",
-            "-max_muxing_queue_size", "512",
-            "-f", "null",
-            "null",
-        ]
-    else:
-        ffmpeg_args = [
-            FFMPEG_PATH,
-            "-hide_banner",
-            "-user_agent", USER_AGENT,
-            "-fflags", "+nobuffer+discardcorrupt",
-            "-flags", "low_delay",
-            "-rtbufsize", "10M",
-            "-i", video_url,
-            "-c", "copy",
-            "-f", "null",
-            "null",
-        ]
+    video_url = stream_url_format.format(id=stream_id)
+    ffmpeg_args = [*FFMPEG_INPUT_ARGS, video_url, *FFMPEG_OUTPUT_ARGS]
+    # Only stderr is read, stdout is discarded so it can never fill up and block FFmpeg
+    # stderr is read as bytes, lines are only decoded when they are printed
     process = subprocess.Popen(
-        ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        ffmpeg_args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
     )
-    watchdog_processes[stream_id] = process
-    watchdog_names[stream_id] = stream_name  # Store the stream name
+    watchdog = Watchdog(process, stream_name)
+    with watchdogs_lock:
+        watchdogs[stream_id] = watchdog
     # Start a thread to monitor speed from FFmpeg output
-    Thread(target=monitor_ffmpeg_output, args=(stream_id, process), daemon=True).start()
+    Thread(target=monitor_ffmpeg_output, args=(stream_id, watchdog), daemon=True).start()
     print(f"Started watchdog for channel ID: {stream_id} - {stream_name}")
 
 
-def stop_watchdog(stream_id, stream_name="", expected_stop=True):
-    """Stop the FFmpeg watchdog process for a given stream ID."""
-    process = watchdog_processes.pop(stream_id, None)
-    # Check if process exited
-    if process is not None:
+def stop_watchdog(stream_id, stream_name="", expected_stop=True, watchdog=None):
+    """Stop the FFmpeg watchdog process for a given stream ID, only if it is still the given watchdog when one is passed."""
+    with watchdogs_lock:
+        # Leave the stream alone if it has already been stopped or restarted with a new watchdog
+        if watchdog is not None and watchdogs.get(stream_id) is not watchdog:
+            return
+        watchdog = watchdogs.pop(stream_id, None)
+    # Check if process exited, terminating outside the lock so other streams aren't held up
+    if watchdog is not None:
+        process = watchdog.process
         if process.poll() is None:
             process.terminate()
             try:
@@ -150,156 +185,125 @@ def stop_watchdog(stream_id, stream_name="", expected_stop=True):
                 print(f"⚠️ FFmpeg process {stream_id} did not terminate in time. Forcing stop.")
                 process.kill()  # Forcefully kill the process
                 process.wait()  # Ensure cleanup
-    watchdog_speeds.pop(stream_id, None)
-    buffer_start_times.pop(stream_id, None)
-    action_triggered.discard(stream_id)
-    # Remove the stream name entry from watchdog_names
-    if stream_id in watchdog_names:
-        del watchdog_names[stream_id]  # Remove from the dictionary
     if expected_stop:
         print(f"Stopped watchdog for channel ID: {stream_id} - {stream_name}")
     else:
         print(f"Watchdog process ended unexpectedly for channel ID: {stream_id} - {stream_name}")
 
-def monitor_ffmpeg_output(stream_id, process):
+def parse_speed(line):
+    """Return the speed from an FFmpeg progress line, or None if the line has no speed."""
+    if not line.startswith(SPEED_PREFIX):
+        return None
+    try:
+        return float(line[len(SPEED_PREFIX):].rstrip(b"x"))
+    except ValueError:
+        return None  # FFmpeg reports N/A until it has processed some input
+
+def monitor_ffmpeg_output(stream_id, watchdog):
     """Monitor FFmpeg output for speed and errors, with cooldown before switching streams."""
-    global watchdog_names
-    # Regular expression to capture the speed value from FFmpeg output
-    speed_pattern = re.compile(r"speed=\s*(\d+\.?\d*)x")
-    # Define error patterns
-    ERROR_PATTERNS = [
-        re.compile(r"corrupt decoded frame"),
-        re.compile(r"error while decoding"),
-        re.compile(r"Invalid data found when processing input"),
-        re.compile(r"Reference \d+ >= \d+"),
-        re.compile(r"concealing \d+ DC, \d+ AC, \d+ MV errors"),
-    ]
+    process = watchdog.process
     # Variables to track stream switching and errors
     stream_switched = False  # Ensures only one switch per buffering instance
     error_count = 0  # Tracks the number of FFmpeg errors
     error_start_time = None  # Records the start time of error occurrences
-    last_switch_time = 0  # Tracks the last time a stream was switched
-    continue_read = True
+    last_switch_time = float("-inf")  # Tracks the last time a stream was switched, -inf means never
     try:
-        while process.poll() is None:  # While FFmpeg is running
-            for line in iter(process.stderr.readline, ''):
-                if continue_read is False:
-                    break
-                line = line.strip()
-                stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                # Check for speed issues (buffering)
-                speed_match = speed_pattern.search(line)
-                if speed_match:
-                    speed = float(speed_match.group(1))
-                    watchdog_speeds[stream_id] = speed  # Store current speed
-                    #stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-
-                    # Detect buffering if speed drops below threshold
-                    if speed < BUFFER_SPEED_THRESHOLD:
-                        if stream_id not in buffer_start_times:
-                            buffer_start_times[stream_id] = time.time()
-                            stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                            print(f"⚠️ Buffering detected on channel {stream_id} - {stream_name}.")
-
-                        # Calculate how long buffering has persisted
-                        buffering_duration = time.time() - buffer_start_times[stream_id]
-
-                        # If buffering persists beyond the defined threshold, consider switching
-                        if buffering_duration >= BUFFER_TIME_THRESHOLD:
-                            # Ensure we don’t switch too frequently
-                            if not stream_switched or (time.time() - last_switch_time > BUFFER_TIME_THRESHOLD + BUFFER_EXTENSION_TIME):
-                                stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-
-                                # Determine how long buffering has occurred (before or after switching)
-                                if stream_switched:
-                                    stream_buffering_duration = time.time() - last_switch_time
-                                else:
-                                    stream_buffering_duration = buffering_duration
-                                print(f"⏳ Buffering persisted on channel {stream_id} ({stream_name}) for {stream_buffering_duration:.2f} seconds (total buffering time: {buffering_duration:.2f} seconds).")
-                                # Run custom command if enabled
-                                if CUSTOM_COMMAND:
-                                    Thread(target=execute_and_monitor_command, args=(CUSTOM_COMMAND, 10), daemon=True).start()
-                                # Attempt to switch to the next available stream
-                                if send_next_stream(stream_id, SERVER_URL, USERNAME, PASSWORD):
-                                    # Update watchdog names to reflect new stream name
-                                    current_streams, watchdog_names = get_running_streams(SERVER_URL, USERNAME, PASSWORD)
-                                    stream_switched = True
-                                    last_switch_time = time.time()  # Update last switch time
-                                    stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                                    print(f"✅ Switched stream for channel {stream_id} - {stream_name}.")
-                                else:
-                                    print(f"❌ Failed to switch stream for channel {stream_id}.")
-                    else:
-                        # Reset buffering state when speed returns to normal
-                        if stream_id in buffer_start_times:
-                            del buffer_start_times[stream_id]
-                            stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                            print(f"✅ Buffering resolved for channel {stream_name}.")
-
-                        # Allow future switches when buffering is no longer an issue
-                        stream_switched = False
-                        last_switch_time = 0  # Reset switch cooldown
-
-                # Check for FFmpeg errors if enabled
-                if ERROR_THRESHOLD > 0:
-                    for error_pattern in ERROR_PATTERNS:
-                        if error_pattern.search(line):
-                            error_count += 1
-                            #stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                            print(f"⚠️ FFmpeg error detected on channel {stream_id} ({stream_name}): {line}")
-
-                            # Record the first error time
-                            if error_start_time is None:
-                                error_start_time = time.time()
-
-                            # Reset error count if errors occur too far apart
-                            if time.time() - error_start_time > ERROR_RESET_TIME:
-                                error_count = 1
-                                error_start_time = time.time()
-
-                            # If too many errors occur within the threshold, switch streams
-                            if error_count >= ERROR_THRESHOLD:
-                                current_time = time.time()
-
-                                # Prevent switching if still within the cooldown period
-                                if current_time - last_switch_time < ERROR_SWITCH_COOLDOWN:
-                                    print(f"🕒 Cooldown active. Not switching channel {stream_id} ({stream_name}) yet.")
-                                    continue  # Skip switching
-                                stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                                print(f"❌ Too many errors on channel {stream_name}. Switching stream.")
-                                # Run custom command if enabled
-                                if CUSTOM_COMMAND:
-                                    Thread(target=execute_and_monitor_command, args=(CUSTOM_COMMAND, 10), daemon=True).start()
-                                # Attempt to switch the stream
-                                if send_next_stream(stream_id, SERVER_URL, USERNAME, PASSWORD):
-                                    # Update watchdog names to reflect new stream name
-                                    current_streams, watchdog_names = get_running_streams(SERVER_URL, USERNAME, PASSWORD)
-                                    stream_switched = True
-                                    last_switch_time = current_time  # Update last switch time
-                                    stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                                    error_count = 0
-                                    print(f"✅ Switched stream for channel {stream_id} - {stream_name}.")
-                                else:
-                                    print(f"❌ Failed to switch channel {stream_id}.")
-                                # Max number of errors reached, break out of for loop
-                                continue_read = False
-                                break
-            # Change continue read back to true
-            continue_read = True
+        for line in process.stderr:  # Ends when FFmpeg exits and closes stderr
+            line = line.strip()
+            stream_name = watchdog.name
+            # Check for speed issues (buffering)
+            speed = parse_speed(line)
+            if speed is not None:
+                watchdog.speed = speed  # Store current speed
+                now = time.monotonic()  # Read the clock once per progress update
+
+                # Detect buffering if speed drops below threshold
+                if speed < BUFFER_SPEED_THRESHOLD:
+                    if watchdog.buffer_start is None:
+                        watchdog.buffer_start = now
+                        print(f"⚠️ Buffering detected on channel {stream_id} - {stream_name}.")
+
+                    # Calculate how long buffering has persisted
+                    buffering_duration = now - watchdog.buffer_start
+
+                    # If buffering persists beyond the defined threshold, consider switching
+                    if buffering_duration >= BUFFER_TIME_THRESHOLD:
+                        # Ensure we don’t switch too frequently
+                        if not stream_switched or (now - last_switch_time > BUFFER_TIME_THRESHOLD + BUFFER_EXTENSION_TIME):
+                            # Determine how long buffering has occurred (before or after switching)
+                            if stream_switched:
+                                stream_buffering_duration = now - last_switch_time
+                            else:
+                                stream_buffering_duration = buffering_duration
+                            print(f"⏳ Buffering persisted on channel {stream_id} ({stream_name}) for {stream_buffering_duration:.2f} seconds (total buffering time: {buffering_duration:.2f} seconds).")
+                            # Run custom command if enabled
+                            if CUSTOM_COMMAND:
+                                Thread(target=execute_and_monitor_command, args=(CUSTOM_COMMAND, 10), daemon=True).start()
+                            # Attempt to switch to the next available stream
+                            if send_next_stream(stream_id, SERVER_URL, USERNAME, PASSWORD):
+                                # The new stream name is picked up by the next monitor_streams poll
+                                stream_switched = True
+                                last_switch_time = time.monotonic()  # Update last switch time
+                                print(f"✅ Switched away from {stream_name} on channel {stream_id}.")
+                            else:
+                                print(f"❌ Failed to switch stream for channel {stream_id}.")
+                else:
+                    # Reset buffering state when speed returns to normal
+                    if watchdog.buffer_start is not None:
+                        watchdog.buffer_start = None
+                        print(f"✅ Buffering resolved for channel {stream_name}.")
+
+                    # Allow future switches when buffering is no longer an issue
+                    stream_switched = False
+                    last_switch_time = float("-inf")  # Reset switch cooldown
+
+            # Check for FFmpeg errors if enabled
+            if ERROR_THRESHOLD > 0:
+                # Progress lines are never errors, only search the log lines
+                if not PROGRESS_LINE.match(line) and ERROR_PATTERN.search(line):
+                    now = time.monotonic()  # Read the clock once per error line
+                    error_count += 1
+                    print(f"⚠️ FFmpeg error detected on channel {stream_id} ({stream_name}): {line.decode(errors='replace')}")
+
+                    # Record the first error time
+                    if error_start_time is None:
+                        error_start_time = now
+
+                    # Reset error count if errors occur too far apart
+                    if now - error_start_time > ERROR_RESET_TIME:
+                        error_count = 1
+                        error_start_time = now
+
+                    # If too many errors occur within the threshold, switch streams
+                    if error_count >= ERROR_THRESHOLD:
+                        # Prevent switching if still within the cooldown period
+                        if now - last_switch_time < ERROR_SWITCH_COOLDOWN:
+                            print(f"🕒 Cooldown active. Not switching channel {stream_id} ({stream_name}) yet.")
+                            continue  # Skip switching
+                        print(f"❌ Too many errors on channel {stream_name}. Switching stream.")
+                        # Run custom command if enabled
+                        if CUSTOM_COMMAND:
+                            Thread(target=execute_and_monitor_command, args=(CUSTOM_COMMAND, 10), daemon=True).start()
+                        # Attempt to switch the stream
+                        if send_next_stream(stream_id, SERVER_URL, USERNAME, PASSWORD):
+                            # The new stream name is picked up by the next monitor_streams poll
+                            stream_switched = True
+                            last_switch_time = now  # Update last switch time
+                            error_count = 0
+                            print(f"✅ Switched away from {stream_name} on channel {stream_id}.")
+                        else:
+                            print(f"❌ Failed to switch channel {stream_id}.")
 
     except Exception as e:
         print(f"❌ Error in FFmpeg process: {e}")
 
     finally:
         # Ensure that the watchdog process is properly stopped if needed
-        if watchdog_processes.get(stream_id):
-            stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-            stop_watchdog(stream_id, stream_name, False)
+        stop_watchdog(stream_id, watchdog.name, False, watchdog)
 
 
 def monitor_streams():
     """Monitor and manage streams periodically."""
-    global watchdog_names
     while True:
         try:
             current_streams, watchdog_names = get_running_streams(SERVER_URL, USERNAME, PASSWORD)
@@ -309,56 +313,54 @@ def monitor_streams():
                 stream_id = stream["id"]
                 stream_name = watchdog_names.get(stream_id, "Unknown Stream")
                 clients = stream["clients"]
+                watchdog = watchdogs.get(stream_id)
+                if watchdog is not None:
+                    watchdog.name = stream_name  # Keep the name current after stream switches
                 # Add watchdog to unmonitored streams
-                if stream_id not in watchdog_processes and USER_AGENT not in clients:
-                    # Remove watchdog_speeds for stream_id if exists
-                    watchdog_speeds.pop(stream_id, None)
+                if watchdog is None and USER_AGENT not in clients:
                     start_watchdog(stream_id, stream_name)
                 # Disconnect if watchdog is the only client
                 elif USER_AGENT in clients and len(clients) == 1:
                     stop_watchdog(stream_id, stream_name, True)
                 # Close FFMPEG process if running but API doesn't return it as a client
-                elif (USER_AGENT not in clients) and (stream_id in watchdog_processes):
+                elif (USER_AGENT not in clients) and (watchdog is not None):
                     stop_watchdog(stream_id,stream_name,True)
             # Stop watchdogs for streams no longer running
-            for stream_id in list(watchdog_processes):
+            for stream_id, watchdog in list(watchdogs.items()):
                 if stream_id not in current_ids:
-                    stop_watchdog(stream_id, stream_name, True)
+                    stop_watchdog(stream_id, watchdog.name, True)
             # Display the current speed of each watchdog
-            for stream_id, speed in watchdog_speeds.items():
-                if watchdog_processes.get(stream_id) is not None:
-                    stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                    print(f"Channel ID: {stream_id} - Current Speed: {speed:.2f}x - {stream_name}")
-                else:
-                    # Remove watchdog_speed if stream_id is no longer a running process
-                    watchdog_speeds.pop(stream_id)
+            for stream_id, watchdog in list(watchdogs.items()):
+                if watchdog.speed is not None:
+                    print(f"Channel ID: {stream_id} - Current Speed: {watchdog.speed:.2f}x - {watchdog.name}")
+            # Monitor the current watchdog ffmpeg processes for high memory usage
+            monitor_ffmpeg_memory(watchdogs)
         except Exception as e:
             print(f"❌ Error in monitoring streams: {e}")
         except KeyboardInterrupt:
             print("Interrupted by user. Cleaning up...")
-            for stream_id in list(watchdog_processes):
-                stop_watchdog(stream_id, stream_name, True)
+            for stream_id, watchdog in list(watchdogs.items()):
+                stop_watchdog(stream_id, watchdog.name, True)
             break
         # Wait for the next query cycle
         time.sleep(QUERY_INTERVAL)
-        # Monitor the current watchdog ffmpeg processes for high memory usage
-        Thread(target=monitor_ffmpeg_memory, args=(watchdog_processes,), daemon=True).start()
 
-def monitor_ffmpeg_memory(watchdog_processes, max_memory_mb=MAX_FFMPEG_MEMORY_MB):
+def monitor_ffmpeg_memory(watchdogs, max_memory_mb=MAX_FFMPEG_MEMORY_MB):
     """Monitor all FFmpeg processes and restart them if memory usage exceeds max_memory_mb."""
-    for stream_id, process in list(watchdog_processes.items()):
+    for stream_id, watchdog in list(watchdogs.items()):
+        process = watchdog.process
         if process.poll() is None:  # Process is still running
             try:
-                mem_usage = psutil.Process(process.pid).memory_info().rss / (1024 * 1024)  # Convert bytes to MB
+                if watchdog.psutil_process is None:
+                    watchdog.psutil_process = psutil.Process(process.pid)
+                mem_usage = watchdog.psutil_process.memory_info().rss / (1024 * 1024)  # Convert bytes to MB
 
                 if mem_usage > max_memory_mb:
                     print(f"⚠️ FFmpeg process {stream_id} exceeded {max_memory_mb:.2f}MB! Restarting...")
                     process.kill()  # Kill the process
                     process.wait(timeout=5)  # Ensure it fully exits
-                    watchdog_processes.pop(stream_id, None)  # Remove from tracking
-                    stream_name = watchdog_names.get(stream_id, "Unknown Stream")
-                    stop_watchdog(stream_id, stream_name)
-                    start_watchdog(stream_id, stream_name)  # Restart
+                    stop_watchdog(stream_id, watchdog.name)  # Remove from tracking
+                    start_watchdog(stream_id, watchdog.name)  # Restart
 
             except (psutil.NoSuchProcess, psutil.AccessDenied):
                 continue  # Process might have already exited